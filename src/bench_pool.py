@@ -0,0 +1,48 @@
+"""
+Benchmark `LoaderPool` against one loader per file, with `StubLoader` so it runs anywhere.
+"""
+
+import click as cli
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from utils import LoaderPool, StubLoader
+
+
+
+@cli.command(context_settings={"help_option_names": ["--help", "-h"], "show_default": True})
+@cli.option("--number-files", "-f", "nb_files", type=cli.IntRange(min=1), default=64,
+            help="Number of fake files.")
+@cli.option("--number-workers", "-n", "nb_workers", type=cli.IntRange(min=1), default=4,
+            help="Number of worker threads.")
+@cli.option("--cached-sources", type=cli.IntRange(min=0), default=16,
+            help="Image sources kept by each worker.")
+@cli.option("--delay", type=cli.FloatRange(min=0), default=0.01,
+            help="Seconds to create a loader or load a file.")
+def benchmark(nb_files, nb_workers, cached_sources, delay):
+    """
+    Compare a loader per file with `LoaderPool`, using `StubLoader`. Files are read twice, as in
+    `all2vox`: once to plan them, then in another order to convert them, by the same workers.
+    """
+    fnames = [ f"file{i:03d}.dcm" for i in range(nb_files) ]
+    order = np.random.default_rng(0).permutation(fnames).tolist()
+    def per_file(fname):
+        loader = StubLoader(delay)
+        loader.LoadFile(fname)
+        return loader.GetImageSource()
+    pool = LoaderPool(lambda: StubLoader(delay), max_sources=cached_sources)
+    for name, plan, run in (("Loader per file", per_file, per_file),
+                            ("Pool", pool.load, lambda fname: pool.load(fname, keep=False))):
+        start = perf_counter()
+        with ThreadPoolExecutor(nb_workers) as ex:
+            assert list(ex.map(plan, fnames)) == fnames
+            assert list(ex.map(run, order)) == order
+        print(f"{name}: {perf_counter() - start:.2f}s")
+    print(f"Pool stats: {dict(pool.stats)}")
+
+
+
+if __name__ == "__main__":
+    benchmark()
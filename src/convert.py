@@ -4,47 +4,87 @@ Convert HDFs to NIfTIs and vice versa. Tool box for NTNU-Polimi collaboration.
 
 import click as cli
 import h5py
+import json
 import nibabel as nib
 import numpy as np
 
+from contextlib import nullcontext
 from pathlib import Path
+from tqdm import tqdm
 from tqdm.contrib.concurrent import thread_map
 
-from utils import get_affine, get_fname, resample_voxel_grid, to_onehot, to_labels
+from utils import (GB, Catalog, DatasetStore, Job, Manifest, Scratch, StoreWriter, budget_map,
+                   close_hdf, get_affine, get_fname, in_shard, memory_hdf, parse_shard, print_plan,
+                   resample_voxel_grid, scratch_hdf, to_onehot, to_labels, verify_manifests)
+from utils.voxels import UNITS
 
 
 
-def _nii2hdf(iname, gtdir, hdfdir, scaling=[0.0005, 0.0005, 0.0005]):
+def _nii2hdf(iname, gtdir, hdfdir, scaling=[0.0005, 0.0005, 0.0005], store=None, scratchdir=None,
+             slab=32, catalog=None):
     if iname.suffix != ".nii":
         print(f"Skipping {iname.name}, not an NIfTI.")
         return
+    if store is not None and iname.stem in store:
+        print(f"Skipping {iname.name}, already in store.")
+        return
     # idir in contained in iname
     hname = get_fname(iname, hdfdir, ".h5")
     gtname = get_fname(iname, gtdir, ".nii")
     frame = "01" # There's only one frame in the given NIfTIs
     scaling = np.array(scaling)
-    # Save input
-    iimg = nib.load(iname)
-    iarr = resample_voxel_grid(iimg, scaling)
-    hdf = h5py.File(hname, 'w')
-    inp = hdf.create_group("CartesianVolume")
-    inp.create_dataset(f"vol{frame}", data=iarr)
-    # Save ground truth
-    gt = hdf.create_group("GroundTruth")
-    gtimg = nib.load(gtname)
-    gtarr = np.array(gtimg.dataobj, dtype=np.uint8)
-    # Receive label encoding with 1=mitral annulus, 2=anterior, 3=posterior
-    onehot = nib.Nifti1Image(to_onehot(gtarr, [0, 1]), gtimg.affine, gtimg.header)
-    onehot = resample_voxel_grid(onehot, scaling, bool, order=0)
-    gt.create_dataset(f"anterior-{frame}", data=onehot[0])
-    gt.create_dataset(f"posterior-{frame}", data=onehot[1])
-    # Save additional information
-    info = hdf.create_group("VolumeGeometry")
-    info.create_dataset("frameNumber", data=int(frame))
-    info.create_dataset("directions", data=iimg.affine[:3, :3])
-    info.create_dataset("origin", data=iimg.affine[:3, -1])
-    info.create_dataset("resolution", data=scaling)
-    hdf.close()
+    if store is None:
+        hdf = h5py.File(hname, 'w')
+    else:
+        hdf = memory_hdf() if scratchdir is None else scratch_hdf(scratchdir)
+    remove = store is not None and scratchdir is not None # Temporary HDF, see `scratch_hdf`
+    try:
+        # Out-of-core mode, resampled grids are kept in scratch files and computed by slabs
+        with (nullcontext() if scratchdir is None else Scratch(scratchdir, slab)) as scratch:
+            # Save input
+            iimg = nib.load(iname)
+            iarr = resample_voxel_grid(iimg, scaling, scratch=scratch)
+            inp = hdf.create_group("CartesianVolume")
+            inp.create_dataset(f"vol{frame}", data=iarr)
+            # Save ground truth
+            gt = hdf.create_group("GroundTruth")
+            gtimg = nib.load(gtname)
+            gtarr = np.array(gtimg.dataobj, dtype=np.uint8)
+            # Receive label encoding with 1=mitral annulus, 2=anterior, 3=posterior
+            onehot = nib.Nifti1Image(to_onehot(gtarr, [0, 1]), gtimg.affine, gtimg.header)
+            onehot = resample_voxel_grid(onehot, scaling, bool, order=0, scratch=scratch)
+            gt.create_dataset(f"anterior-{frame}", data=onehot[0])
+            gt.create_dataset(f"posterior-{frame}", data=onehot[1])
+            # Save additional information
+            info = hdf.create_group("VolumeGeometry")
+            info.create_dataset("frameNumber", data=int(frame))
+            info.create_dataset("directions", data=iimg.affine[:3, :3])
+            info.create_dataset("origin", data=iimg.affine[:3, -1])
+            info.create_dataset("resolution", data=scaling)
+            info.create_dataset("shape", data=iarr.shape)
+            del iarr, onehot # Release scratch files before removing them
+        if store is None and catalog is not None: # Store's writer does it otherwise
+            catalog.add(iname.stem, hdf, hname)
+    except BaseException:
+        close_hdf(hdf, remove) # Don't leave temporary files behind
+        raise
+    if store is None:
+        hdf.close()
+    else: # Store's writer closes (and removes) it, wait until it's committed (see `all2vox`)
+        store.put(iname.stem, hdf, remove).result()
+
+def _plan_nii(iname, scaling, ooc=False):
+    # Only the header is read, data stay on disk
+    header = nib.load(iname).header
+    shape = np.array(header.get_data_shape()[:3])
+    res = UNITS[header.get_xyzt_units()[0]] * np.array(header.get_zooms()[:3])
+    new_shape = np.round(shape * res / scaling).astype(int)
+    nb_in, nb_out = int(np.prod(shape)), int(np.prod(new_shape))
+    # Input and its two onehot masks, at both resolutions (uint8/bool)
+    memory = 4 * nb_in + 6 * nb_out
+    if ooc: # Resampled grids are on disk, only slabs of them are in memory
+        memory = 4 * nb_in
+    return Job(iname, nb_in + nb_out, memory, f"shape {shape.tolist()} -> {new_shape.tolist()}")
 
 def _hdf2nii(fname, idir, gtdir, middle):
     if fname.suffix != ".h5":
@@ -95,21 +135,63 @@ def main():
             help="Where to store all voxel grids.")
 @cli.option("--scaling", "-s", type=cli.Tuple([cli.FloatRange(min=0)] * 3),
             nargs=3, default=[0.0005] * 3, help="Resolution of a voxel in meter.")
+@cli.option("--store", "storepath", type=cli.Path(resolve_path=True, path_type=Path, dir_okay=False),
+            help=("Append every NIfTI to this single HDF instead of one HDF per NIfTI. "
+                  "NIfTIs already in it are skipped, so an interrupted run can be resumed."))
 @cli.option("--number-workers", "-n", "nb_workers", type=cli.IntRange(min=1), default=1,
             help="Number of workers used to accelerate file processing.")
-def nii2hdf(idir, gtdir, hdfdir, scaling, nb_workers):
+@cli.option("--memory-budget", "-b", type=cli.FloatRange(min=0),
+            help=("Memory in GB that running conversions can use together, fewer workers run at "
+                  "once when NIfTIs are big. No limit other than `number-workers` if not given."))
+@cli.option("--dry-run", is_flag=True, default=False,
+            help="Only print the planned order and memory estimate of each NIfTI.")
+@cli.option("--scratch-directory", "scratchdir",
+            type=cli.Path(resolve_path=True, path_type=Path, file_okay=False),
+            help=("Out-of-core mode: resample by slabs into memory-mapped files of this directory, "
+                  "for grids that don't fit in memory."))
+@cli.option("--slab-size", "slab", type=cli.IntRange(min=1), default=32,
+            help="Number of voxels along first axis resampled at once in out-of-core mode.")
+@cli.option("--catalog", "catalogpath",
+            type=cli.Path(resolve_path=True, path_type=Path, dir_okay=False),
+            help="SQLite catalog of written frames to update, see `query`.")
+@cli.option("--shard", metavar="INDEX/COUNT", callback=parse_shard,
+            help=("Only convert NIfTIs of shard INDEX (from 0) out of COUNT, and write a "
+                  "manifest of the converted ones. See `verify`."))
+def nii2hdf(idir, gtdir, hdfdir, scaling, storepath, nb_workers, memory_budget, dry_run,
+            scratchdir, slab, catalogpath, shard):
     """
     Convert two NIfTIs volumes to HDFs, associating NIfTIs for input and ground truth in one HDF.
 
     \b
     IDIR     PATH    Directory of input NIfTIs.
     GTDIR    PATH    Directory of ground truth NIfTIs.
+
+    NIfTIs are converted largest first, their size is estimated from their header.
     """
-    hdfdir.mkdir(parents=True, exist_ok=True)
-    nbfiles = len(list(idir.glob("*.nii")))
-    thread_map(lambda fname: _nii2hdf(fname, gtdir, hdfdir, scaling), idir.iterdir(), max_workers=nb_workers,
-               # Pretty progress bar
-               desc="Processed", unit="files", total=nbfiles, colour="green")
+    inames = sorted(idir.glob("*.nii"))
+    jobs = [ _plan_nii(fname, scaling, scratchdir is not None) for fname in inames
+             if in_shard(fname.stem, shard) ]
+    memory_budget = memory_budget * GB if memory_budget else None
+    if dry_run:
+        print_plan(jobs, memory_budget, nb_workers)
+        return
+    if storepath is None:
+        hdfdir.mkdir(parents=True, exist_ok=True)
+    else:
+        storepath.parent.mkdir(parents=True, exist_ok=True)
+    if scratchdir is not None:
+        scratchdir.mkdir(parents=True, exist_ok=True)
+    manifest = Manifest(hdfdir if storepath is None else storepath.parent, "nii2hdf", shard,
+                        cli.get_current_context().params, [ f.stem for f in inames ])
+    catalog = None if catalogpath is None else Catalog(catalogpath)
+    writer = nullcontext() if storepath is None else StoreWriter(storepath, nb_workers, catalog)
+    # Manifest is saved and catalog closed after the store's writer is done
+    with manifest, catalog or nullcontext(), writer as store:
+        budget_map(manifest.track(lambda fname: _nii2hdf(fname, gtdir, hdfdir, scaling, store,
+                                                         scratchdir, slab, catalog)),
+                   jobs, max_workers=nb_workers, memory_budget=memory_budget,
+                   # Pretty progress bar
+                   desc="Processed", unit="files", colour="green")
 
 @main.command(name="hdf2nii", short_help="Convert HDFs to NIfTIs.")
 @cli.argument("hdfdir", type=cli.Path(exists=True, resolve_path=True, path_type=Path, file_okay=False))
@@ -123,7 +205,10 @@ def nii2hdf(idir, gtdir, hdfdir, scaling, nb_workers):
             help="Only convert middle frame contained in an HDF.")
 @cli.option("--number-workers", "-n", "nb_workers", type=cli.IntRange(min=1), default=1,
             help="Number of workers used to accelerate file processing.")
-def hdf2nii(hdfdir, idir, gtdir, middle, nb_workers):
+@cli.option("--shard", metavar="INDEX/COUNT", callback=parse_shard,
+            help=("Only convert HDFs of shard INDEX (from 0) out of COUNT, and write a "
+                  "manifest of the converted ones. See `verify`."))
+def hdf2nii(hdfdir, idir, gtdir, middle, nb_workers, shard):
     """
     Convert HDFs containing multiple volumes to several NIfTIs each containing one
     volume. Inputs and ground truth are stored in separate directories.
@@ -131,10 +216,101 @@ def hdf2nii(hdfdir, idir, gtdir, middle, nb_workers):
     HDFDIR    PATH    Directory of HDFs containing voxels.
     """
     idir.mkdir(parents=True, exist_ok=True), gtdir.mkdir(parents=True, exist_ok=True)
-    nbfiles = len(list(hdfdir.glob("*.h5")))
-    thread_map(lambda fname: _hdf2nii(fname, idir, gtdir, middle), hdfdir.iterdir(), max_workers=nb_workers,
-               # Pretty progress bar
-               desc="Processed", unit="files", total=nbfiles, colour="green")
+    fnames = sorted(hdfdir.glob("*.h5"))
+    manifest = Manifest(idir, "hdf2nii", shard, cli.get_current_context().params,
+                        [ f.stem for f in fnames ])
+    fnames = [ f for f in fnames if in_shard(f.stem, shard) ]
+    with manifest:
+        thread_map(manifest.track(lambda fname: _hdf2nii(fname, idir, gtdir, middle)), fnames,
+                   max_workers=nb_workers,
+                   # Pretty progress bar
+                   desc="Processed", unit="files", colour="green")
+
+@main.command(name="store2hdf", short_help="Export a consolidated store to HDFs.")
+@cli.argument("storepath", type=cli.Path(exists=True, resolve_path=True, path_type=Path, dir_okay=False))
+@cli.option("--hdf-directory", "-d", "hdfdir", default="hdf",
+            type=cli.Path(resolve_path=True, path_type=Path, file_okay=False),
+            help="Where to store exported HDFs.")
+def store2hdf(storepath, hdfdir):
+    """
+    Export every sequence of a consolidated store (see `--store`) to its own HDF, with the
+    same layout as when no store is used.
+
+    STOREPATH    PATH    Consolidated HDF.
+    """
+    hdfdir.mkdir(parents=True, exist_ok=True)
+    store = DatasetStore(storepath, 'r')
+    names = store.names()
+    # Single reader, HDF reads aren't parallel anyway
+    for name in tqdm(names, desc="Exported", unit="sequence", colour="green"):
+        store.export(name, hdfdir.joinpath(name).with_suffix(".h5"))
+    store.close()
+
+@main.command(name="verify", short_help="Check shards' manifests.")
+@cli.argument("paths", nargs=-1, required=True,
+              type=cli.Path(exists=True, resolve_path=True, path_type=Path))
+@cli.option("--merge", "-m", "merged", type=cli.Path(resolve_path=True, path_type=Path, dir_okay=False),
+            help="Where to write the manifest of all shards, if they are consistent.")
+def verify(paths, merged):
+    """
+    Check that the manifests written by `--shard` runs cover every input exactly once, with the
+    same command and parameters. Exit with an error listing the problems otherwise.
+
+    PATHS    PATH    Manifests, or directories containing them.
+    """
+    fnames = []
+    for p in paths:
+        fnames += sorted(p.glob("manifest-*-of-*.json")) if p.is_dir() else [p]
+    if not fnames:
+        raise cli.ClickException("No manifest found.")
+    manifests = []
+    for fname in fnames:
+        with open(fname) as fd:
+            manifests.append(json.load(fd))
+    errors = verify_manifests(manifests)
+    if errors:
+        raise cli.ClickException("\n".join(errors))
+    ref = manifests[0]
+    print(f"{len(ref['inputs'])} inputs produced once by {ref['shard'][1]} shards.")
+    if merged is not None:
+        with open(merged, 'w') as fd:
+            json.dump({"command": ref["command"], "parameters": ref["parameters"],
+                       "shards": ref["shard"][1], "inputs": ref["inputs"],
+                       "done": sorted(n for m in manifests for n in m["done"]),
+                       "complete": True}, fd, indent=1)
+
+@main.command(name="query", short_help="Select frames from a catalog.")
+@cli.argument("catalogpath", type=cli.Path(exists=True, resolve_path=True, path_type=Path, dir_okay=False))
+@cli.option("--frame-time", "-t", "ftime", type=float, nargs=2, help="Range of frame time.")
+@cli.option("--ecg-phase", "-p", "phase", type=cli.FloatRange(0, 1), nargs=2,
+            help="Range of fraction of the R-R interval.")
+@cli.option("--resolution", "-r", type=cli.Tuple([cli.FloatRange(min=0)] * 3), nargs=3,
+            help="Resolution of a voxel in meter.")
+@cli.option("--shape", "-s", type=cli.Tuple([cli.IntRange(min=1)] * 3), nargs=3,
+            help="Shape of the voxel grid.")
+@cli.option("--annotated/--not-annotated", "-a/-A", default=None,
+            help="Only frames with (or without) ground truth.")
+@cli.option("--label", "-l", help="Only frames with this mask (e.g. anterior) not empty.")
+@cli.option("--min-voxels", type=cli.IntRange(min=1), default=1,
+            help="Minimum number of voxels in `label` mask.")
+@cli.option("--where", "-w", help="Additional SQL condition on the `frames` table.")
+@cli.option("--level", "-L", type=cli.IntRange(min=0),
+            help="Pyramid level (see `--pyramid`), 0 for the finest grid.")
+def query(catalogpath, ftime, phase, resolution, shape, annotated, label, min_voxels, where,
+          level):
+    """
+    Print frames of a catalog (see `--catalog`) matching every given criterion, as tab separated
+    values: sequence, level, frame, HDF, dataset and row (if stored in a consolidated store).
+
+    CATALOGPATH    PATH    SQLite catalog.
+    """
+    with Catalog(catalogpath) as catalog:
+        rows = catalog.query(ftime or None, phase or None, resolution or None, shape or None,
+                             annotated, label, min_voxels, where, level)
+    print("sequence\tlevel\tframe\tsource\tdataset\trow")
+    for r in rows:
+        print("\t".join(str('' if r[k] is None else r[k])
+                        for k in ("sequence", "level", "frame", "source", "dataset", "row")))
 
 
 
@@ -6,9 +6,12 @@ import comtypes.client as ccomtypes
 import numpy as np
 import platform
 
+from functools import lru_cache
 from pathlib import WindowsPath
+from pythoncom import CoInitialize
 
 from dicoms.utils import safe2np
+from utils.pool import LoaderPool
 
 
 
@@ -17,21 +20,39 @@ from dicoms.utils import safe2np
 ### Change this according to your system ###
 Image3DAPIWin32 = None
 Image3DAPIx64 = WindowsPath("C:/Users/malou/Documents/dev/Image3dAPI/x64/Image3dAPI.tlb")
+# Default number of image sources kept open by each worker, see `all2vox --cached-sources`
+MAX_SOURCES = 0
 
 
 
-def load_dcm(fname):
-    # Load type library
+@lru_cache(maxsize=None)
+def get_api():
+    # Load type library, once per process
     if "32" in platform.architecture()[0]:
-        Image3dAPI = ccomtypes.GetModule(str(Image3DAPIWin32))
-    else:
-        Image3dAPI = ccomtypes.GetModule(str(Image3DAPIx64))
-    # Create loader object
+        return ccomtypes.GetModule(str(Image3DAPIWin32))
+    return ccomtypes.GetModule(str(Image3DAPIx64))
+
+def create_loader():
     loader = ccomtypes.CreateObject("GEHC_CARD_US.Image3dFileLoader")
-    loader = loader.QueryInterface(Image3dAPI.IImage3dFileLoader)
-    # Load file
-    err_type, err_msg = loader.LoadFile(str(fname)) #TODO? Print errors
-    return loader.GetImageSource()
+    return loader.QueryInterface(get_api().IImage3dFileLoader)
+
+# COM is initialized and a loader created once per worker thread, on its first DICOM
+POOL = LoaderPool(create_loader, CoInitialize, MAX_SOURCES)
+
+
+
+def load_dcm(fname, pool=POOL, keep=True):
+    # `keep=False` for the last read of a DICOM, see `LoaderPool.load`
+    return pool.load(fname, keep)
+
+def load_dcm_shape(src, voxres):
+    """ Number of frames and voxel grid shape at `voxres`, without fetching any frame """
+    bbox = src.GetBoundingBox()
+    directions = np.array([[bbox.dir1_x, bbox.dir1_y, bbox.dir1_z],
+                           [bbox.dir2_x, bbox.dir2_y, bbox.dir2_z],
+                           [bbox.dir3_x, bbox.dir3_y, bbox.dir3_z]])
+    # Same as in `dcmseq2vox`
+    return src.GetFrameCount(), np.round(np.linalg.norm(directions, axis=1) / voxres).astype(int)
 
 def load_dcm_info(src, hdf):
     #probe = src.GetProbeInfo() #TODO? Should be saved
@@ -39,7 +60,7 @@ def load_dcm_info(src, hdf):
     ecg = src.GetECG()
     samples = safe2np(ecg.samples)
     trig_time = safe2np(ecg.trig_times)
-    group_ecg = hdf.create_group("/ECG")
+    group_ecg = hdf.require_group("/ECG")
     group_ecg.create_dataset("samples", data=samples)
     group_ecg.create_dataset("times", data=np.linspace(trig_time[0], trig_time[1], 
                                                        num=samples.shape[0]))
@@ -49,7 +70,8 @@ def load_dcm_info(src, hdf):
     dir_x = np.array([bbox.dir1_x, bbox.dir1_y, bbox.dir1_z])
     dir_y = np.array([bbox.dir2_x, bbox.dir2_y, bbox.dir2_z])
     dir_z = np.array([bbox.dir3_x, bbox.dir3_y, bbox.dir3_z])
-    info = hdf.create_group("/VolumeGeometry")
+    # Annotations may have been saved first (e.g. frame times)
+    info = hdf.require_group("/VolumeGeometry")
     info.create_dataset("origin", data=origin)
     info.create_dataset("directions", data=np.stack([dir_x, dir_y, dir_z]))
     # Save color map
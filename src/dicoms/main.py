@@ -6,17 +6,18 @@ import click as cli
 import h5py
 import numpy as np
 
+from contextlib import nullcontext
 from pathlib import WindowsPath
-from pythoncom import CoInitialize
 from tqdm.contrib.concurrent import thread_map
 
 from dicoms.loaders import load_dcm, load_dcm_info
 from dicoms.utils import save_selected_frames
 from dicoms.voxelize import frames2vox
+from utils import Catalog, Manifest, in_shard, parse_shard
 
 
 
-def dcmseq2vox(dcm_src, hdf, voxres, bbox, contrast):
+def dcmseq2vox(dcm_src, hdf, voxres, bbox, contrast, scratch=None):
     info = hdf["VolumeGeometry"]
     if "frameTimes" in info.keys():
         # Voxelize only listed frames (aka annotated close valve)
@@ -26,22 +27,23 @@ def dcmseq2vox(dcm_src, hdf, voxres, bbox, contrast):
     res = np.round(np.linalg.norm(info["directions"], axis=1) / voxres)
     max_res = np.ctypeslib.as_ctypes(res.astype(np.ushort))
     info.create_dataset("resolution", data=voxres)
-    return frames2vox(dcm_src, hdf, bbox, max_res, contrast)
+    return frames2vox(dcm_src, hdf, bbox, max_res, contrast, scratch)
 
 
 
-def _multiprocess(dname, opath, voxres):
+def _multiprocess(dname, opath, voxres, catalog=None):
     """ Wrapper around `dcmseq2vox` """
-    CoInitialize() # Needed to work with comtypes and multithread
     if dname.suffix != ".dcm":
         print(f"Ignoring {dname.name}, not a DICOM.")
         return
     hname = opath.joinpath(dname.with_suffix(".h5").name)
     hdf = h5py.File(hname, 'a') # In case annotations were done first
-    dcm_src = load_dcm(dname)
+    dcm_src = load_dcm(dname, keep=False) # Read only once
     bbox = load_dcm_info(dcm_src, hdf) # Store ECG, origin, directions, ...
-    frames, times = dcmseq2vox(dcm_src, hdf, voxres, bbox)
-    save_selected_frames(frames, hdf, times)
+    frames = dcmseq2vox(dcm_src, hdf, voxres, bbox, False)
+    save_selected_frames(frames, hdf)
+    if catalog is not None:
+        catalog.add(dname.stem, hdf, hname)
     hdf.close()
 
 
@@ -55,7 +57,13 @@ def _multiprocess(dname, opath, voxres):
             help="Where to store generated voxel grids.")
 @cli.option("--number-workers", "-n", "nb_workers", default=1, type=cli.IntRange(min=1),
             help="Number of workers used to accelerate file processing.")
-def dcm2vox(dicomdir, voxres, opath, nb_workers):
+@cli.option("--catalog", "catalogpath", type=cli.Path(resolve_path=True, path_type=WindowsPath,
+            dir_okay=False),
+            help="SQLite catalog of written frames to update, see `convert.py query`.")
+@cli.option("--shard", metavar="INDEX/COUNT", callback=parse_shard,
+            help=("Only convert DICOMs of shard INDEX (from 0) out of COUNT, and write a "
+                  "manifest of the converted ones. See `convert.py verify`."))
+def dcm2vox(dicomdir, voxres, opath, nb_workers, catalogpath, shard):
     """
     Convert GE DICOMs to HDF. Save each frames with the given resolution. Voxel grid shape will
     depend of the data since the resolution is fixed.
@@ -63,13 +71,18 @@ def dcm2vox(dicomdir, voxres, opath, nb_workers):
     DICOMDIR    PATH    Directory of DICOMs to convert to HDFs.
     """
     opath.mkdir(exist_ok=True)
-    voxres, voxshape = np.array(voxres), np.array(voxshape)
-    nb_files = len(list(dcmdir.glob("*.dcm")))
-    # Allow multithread with nice progress bar
-    thread_map(lambda fname: _multiprocess(fname, opath, voxres),
-               dcmdir.iterdir(), max_workers=nb_workers,
-               # Pretty loading bar
-               desc="Processed", unit="DICOM", total=nb_files, colour="green")
+    voxres = np.array(voxres)
+    dcms = sorted(dicomdir.glob("*.dcm"))
+    manifest = Manifest(opath, "dcm2vox", shard, cli.get_current_context().params,
+                        [ d.stem for d in dcms ])
+    dcms = [ d for d in dcms if in_shard(d.stem, shard) ]
+    catalog = None if catalogpath is None else Catalog(catalogpath)
+    with manifest, catalog or nullcontext():
+        # Allow multithread with nice progress bar
+        thread_map(manifest.track(lambda fname: _multiprocess(fname, opath, voxres, catalog)),
+                   dcms, max_workers=nb_workers,
+                   # Pretty loading bar
+                   desc="Processed", unit="DICOM", colour="green")
 
 
 
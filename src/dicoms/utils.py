@@ -36,7 +36,7 @@ def save_selected_frames(frames, hdf):
     try:
         to_save = hdf["VolumeGeometry"]["frameTimes"][()]
     except KeyError:
-        to_save = np.array(frames.keys())
+        to_save = np.array(list(frames.keys()))
         hdf["VolumeGeometry"].create_dataset("frameNumber", data=len(to_save))
         hdf["VolumeGeometry"].create_dataset("frameTimes", data=to_save)
     vol = hdf.create_group("/CartesianVolume")
@@ -4,10 +4,11 @@ from warnings import warn
 
 from dicoms.utils import frame2arr
 from utils import LUT
+from utils.slabs import to_scratch
 
 
 
-def frames2vox(dcm_src, hdf, bbox, max_res, contrast):
+def frames2vox(dcm_src, hdf, bbox, max_res, contrast, scratch=None):
     nb_frames = dcm_src.GetFrameCount()
     try:
         # API returns unsigned int
@@ -21,7 +22,8 @@ def frames2vox(dcm_src, hdf, bbox, max_res, contrast):
         frame = dcm_src.GetFrame(f, bbox, max_res)
         arr = frame2arr(frame)
         # Since Python3.7, dict are ordered. This will yield ordered frames
-        out[frame.time] = lut[arr] if contrast else arr
+        # Out-of-core mode keeps frames on disk, only the one being fetched is in memory
+        out[frame.time] = to_scratch(lut[arr] if contrast else arr, scratch)
     #FIXME? Assume same shape for every frame
     hdf["VolumeGeometry"].create_dataset("shape", data=list(out.values())[0].shape)
     # Don't save in HDF here in case you need to remove some frames
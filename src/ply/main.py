@@ -12,7 +12,8 @@ MODE = {"eigen": eigen_extrude, "normal": normal_extrude,
 
 
 
-def plyseq2vox(sequence, frames, hdf, origin, directions, voxres, thickness, mode, pmode):
+def plyseq2vox(sequence, frames, hdf, origin, directions, voxres, thickness, mode, pmode,
+               scratch=None):
     """ Voxelize every frames' annotation in a sequence """
     # HDF file is expected to be open and close outside this function
     mesh2vox = MODE[mode]
@@ -24,8 +25,10 @@ def plyseq2vox(sequence, frames, hdf, origin, directions, voxres, thickness, mod
         t = float(afname.stem.split('-')[1])
         times.append(t)
         pfname = afname.with_stem(f"posterior-{times[-1]}")
-        anteriors[t] = post_process(mesh2vox(afname, frames[t], origin, directions, voxres, thickness), pmode)
-        posteriors[t] = post_process(mesh2vox(pfname, frames[t], origin, directions, voxres, thickness), pmode)
+        anteriors[t] = post_process(mesh2vox(afname, frames[t], origin, directions, voxres, thickness,
+                                             scratch=scratch), pmode, scratch=scratch)
+        posteriors[t] = post_process(mesh2vox(pfname, frames[t], origin, directions, voxres, thickness,
+                                              scratch=scratch), pmode, scratch=scratch)
     info = hdf["VolumeGeometry"]
     info.create_dataset("frameNumber", data=len(times))
     # There's no garanty iterdir sorts files, so we ensure it
@@ -1,6 +1,8 @@
 import numpy as np
 import scipy.ndimage as sci
 
+from utils.slabs import slab_apply
+
 
 
 
@@ -19,10 +21,19 @@ POSTPROCESS = {"erosion": sci.binary_erosion, "dilation": sci.binary_dilation,
 
 
 
-def post_process(x, mode, structure=STRUCT1_5, iterations=10, mask=None, border_value=0, origin=0, brute_force=False):
+def post_process(x, mode, structure=STRUCT1_5, iterations=10, mask=None, border_value=0, origin=0, brute_force=False,
+                 scratch=None):
     if mode is None:
         return x
     if mode == "fill-holes":
-        return POSTPROCESS[mode](x, structure=structure, origin=origin)
-    return POSTPROCESS[mode](x, structure=structure, iterations=iterations, mask=mask,
-                             border_value=border_value, origin=origin, brute_force=brute_force)
+        # Holes can span the whole grid, can't be split in slabs
+        return POSTPROCESS[mode](np.asarray(x), structure=structure, origin=origin)
+    fn = lambda s: POSTPROCESS[mode](s, structure=structure, iterations=iterations, mask=mask,
+                                     border_value=border_value, origin=origin,
+                                     brute_force=brute_force)
+    if scratch is None or iterations < 1 or mask is not None:
+        return fn(np.asarray(x))
+    # Each iteration reaches one structure radius further, twice for opening and closing
+    reach = structure.shape[0] // 2 + int(np.max(np.abs(origin)))
+    halo = iterations * reach * (2 if mode in ("opening", "closing") else 1)
+    return slab_apply(fn, x, scratch.zeros(x.shape, bool), scratch.slab, halo)
@@ -2,6 +2,7 @@ import numpy as np
 import trimesh as tm
 
 from ply.utils import full_load_ply
+from utils.slabs import zeros
 
 
 
@@ -17,7 +18,7 @@ def get_vox_idx(mesh, inc, voxshape, origin, directions, voxres):
     # Ensure all indexes are inside input voxel grid
     return np.unique(idx[is_inside(idx)], axis=0)
 
-def _extrude(mesh, voxshape, origin, directions, voxres, extrude_vec, extrude=0.003):
+def _extrude(mesh, voxshape, origin, directions, voxres, extrude_vec, extrude=0.003, scratch=None):
     """ Code from Sverre Herland """
     # Voxelize every increment around surface with proper spacing to get a full volume
     increments = np.stack([np.arange(-extrude / 2, extrude / 2, vr) for vr in voxres])
@@ -26,13 +27,13 @@ def _extrude(mesh, voxshape, origin, directions, voxres, extrude_vec, extrude=0.
         inc = increments[:,i]
         allidx.append(get_vox_idx(mesh, inc * extrude_vec, voxshape, origin, directions, voxres))
     allidx = np.unique(np.concatenate(allidx, axis=0), axis=0)
-    voxel_grid = np.zeros(voxshape, dtype=bool)
+    voxel_grid = zeros(voxshape, bool, scratch) # On disk in out-of-core mode
     # Set voxels inside leaflets to True
     voxel_grid[allidx[:, 0], allidx[:, 1], allidx[:, 2]] = 1
     return voxel_grid
 
 
-def eigen_extrude(fname, vinput, origin, directions, voxres, extrude=0.003):
+def eigen_extrude(fname, vinput, origin, directions, voxres, extrude=0.003, scratch=None):
     """
     Code from Sverre Herland
     Extrude along the smallest eighen vector of half `extrude` value in each direction.
@@ -43,9 +44,9 @@ def eigen_extrude(fname, vinput, origin, directions, voxres, extrude=0.003):
     covariance = np.cov(mesh.vertices.T)
     eig_vals, eig_vecs = np.linalg.eig(covariance)
     extrude_vec = eig_vecs[np.argmin(eig_vals)] # Should be Y-axis
-    return _extrude(mesh, vinput.shape, origin, directions, voxres, extrude_vec, extrude)
+    return _extrude(mesh, vinput.shape, origin, directions, voxres, extrude_vec, extrude, scratch)
 
-def normal_extrude(fname, vinput, origin, directions, voxres, extrude=0.003):
+def normal_extrude(fname, vinput, origin, directions, voxres, extrude=0.003, scratch=None):
     """
     Extrude along each vertices normals of half `extrude` value in each direction of the normal.
     This method yields a more accurate volume than the `eighen_extrude`
@@ -53,9 +54,10 @@ def normal_extrude(fname, vinput, origin, directions, voxres, extrude=0.003):
     with open(fname, "br") as fd: # Need to be opened in binary mode for Trimesh
         dict_mesh = full_load_ply(fd, prefer_color="face")
     mesh = tm.Trimesh(**dict_mesh)
-    return _extrude(mesh, vinput.shape, origin, directions, voxres, mesh.vertex_normals, extrude)
+    return _extrude(mesh, vinput.shape, origin, directions, voxres, mesh.vertex_normals, extrude,
+                    scratch)
 
-def filter_extrude(fname, vinput, origin, directions, voxres, extrude=0.003, div=1):
+def filter_extrude(fname, vinput, origin, directions, voxres, extrude=0.003, div=1, scratch=None):
     """
     Extrude along each vertices normals of half `extrude` value in each direction of the normal.
     Then refine volume by filtering out outlier voxels with intensity out of mean ± std.
@@ -65,9 +67,9 @@ def filter_extrude(fname, vinput, origin, directions, voxres, extrude=0.003, div
     mesh = tm.Trimesh(**dict_mesh)
     voxshape = vinput.shape
     # Bounding box annotation
-    box = _extrude(mesh, voxshape, origin, directions, voxres, mesh.vertex_normals, extrude)
+    box = _extrude(mesh, voxshape, origin, directions, voxres, mesh.vertex_normals, extrude, scratch)
     idx = np.argwhere(box) # Box is a boolean array
-    out = np.zeros_like(box)
+    out = zeros(voxshape, bool, scratch)
     rmin, rmax = np.min(idx, axis=0), np.max(idx, axis=0) # Indexes range of surface
     strides = ((rmax - rmin) / div).astype(int)
     keep = lambda x: (mean - std <= x)# & (x <= mean + std)
@@ -88,7 +90,7 @@ def filter_extrude(fname, vinput, origin, directions, voxres, extrude=0.003, div
                 out[sidx] = np.where(keep(vinput[sidx]), box[sidx], False)
     return out
 
-def region_growing(fname, vinput, origin, directions, voxres, extrude=0.003, div=2):
+def region_growing(fname, vinput, origin, directions, voxres, extrude=0.003, div=2, scratch=None):
     """
     Extrude along each vertices normals of half `extrude` value in each direction of the normal.
     Then refine volume by keeping voxels which intensity is close enough to the *surface* ones (mean ± std).
@@ -98,9 +100,9 @@ def region_growing(fname, vinput, origin, directions, voxres, extrude=0.003, div
     mesh = tm.Trimesh(**dict_mesh)
     voxshape = vinput.shape
     # Bounding box annotation
-    box = _extrude(mesh, voxshape, origin, directions, voxres, mesh.vertex_normals, extrude)
+    box = _extrude(mesh, voxshape, origin, directions, voxres, mesh.vertex_normals, extrude, scratch)
     idx = get_vox_idx(mesh, 0, voxshape, origin, directions, voxres) # Surface voxels
-    out = np.zeros_like(box)
+    out = zeros(voxshape, bool, scratch)
     rmin, rmax = np.min(idx, axis=0), np.max(idx, axis=0) # Indexes range of surface
     strides = ((rmax - rmin) / div).astype(int)
     keep = lambda x: (mean - std <= x)# & (x <= mean + std)
@@ -2,34 +2,91 @@ import click as cli
 import h5py
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import WindowsPath
-from pythoncom import CoInitialize
-from tqdm.contrib.concurrent import thread_map
+from tqdm import tqdm
 
 from dicoms import dcmseq2vox
-from dicoms.loaders import load_dcm, load_dcm_info
+from dicoms.loaders import MAX_SOURCES, POOL, load_dcm, load_dcm_info, load_dcm_shape
 from dicoms.utils import save_selected_frames
 from ply import plyseq2vox
+from utils import (GB, Catalog, DatasetStore, Job, Manifest, Scratch, StoreWriter, budget_map,
+                   close_hdf, in_shard, memory_hdf, parse_shard, print_plan, save_pyramid, scratch_hdf)
 
 
 
-def seq2vox(dname, pdir, opath, voxres, thickness, mode, contrast, postprocess):
-    CoInitialize() # Needed to work with comtypes and multithread
+def seq2vox(dname, pdir, opath, voxres, thickness, mode, contrast, postprocess,
+            pyramid=(), mask_mode="majority", store=None, scratchdir=None, slab=32, catalog=None):
     if dname.suffix != ".dcm":
         print(f"Ignoring {dname.name}, not a DICOM.")
         return
-    hdf = h5py.File(opath.joinpath(dname.with_suffix(".h5").name), 'w')
-    src = load_dcm(dname)
-    bbox = load_dcm_info(src, hdf)
-    info = hdf["VolumeGeometry"]
-    # Voxelize inputs
-    frames = dcmseq2vox(src, hdf, voxres, bbox, contrast)
-    # Will voxelize and add to HDF, ground truth, frame times and number of frame
-    plyseq2vox(pdir.joinpath(dname.stem), frames, hdf, info["origin"][()],
-               info["directions"][()], voxres, thickness, mode, postprocess)
-    # Save only frame that have an annotation
-    save_selected_frames(frames, hdf)
-    hdf.close()
+    hname = opath.joinpath(dname.with_suffix(".h5").name)
+    if store is None:
+        hdf = h5py.File(hname, 'w')
+    elif dname.stem in store:
+        print(f"Skipping {dname.name}, already in store.")
+        return
+    elif scratchdir is None: # Built in memory, the store's writer will append it
+        hdf = memory_hdf()
+    else:
+        hdf = scratch_hdf(scratchdir)
+    remove = store is not None and scratchdir is not None # Temporary HDF, see `scratch_hdf`
+    try:
+        # Out-of-core mode, grids are kept in scratch files and processed by slabs
+        with (nullcontext() if scratchdir is None else Scratch(scratchdir, slab)) as scratch:
+            src = load_dcm(dname, keep=False) # Last read, may have been cached when planning
+            bbox = load_dcm_info(src, hdf)
+            info = hdf["VolumeGeometry"]
+            # Voxelize inputs
+            frames = dcmseq2vox(src, hdf, voxres, bbox, contrast, scratch)
+            # Will voxelize and add to HDF, ground truth, frame times and number of frame
+            plyseq2vox(pdir.joinpath(dname.stem), frames, hdf, info["origin"][()],
+                       info["directions"][()], voxres, thickness, mode, postprocess, scratch)
+            # Save only frame that have an annotation
+            save_selected_frames(frames, hdf)
+            del frames # Release scratch files before removing them
+        # Derive coarser resolutions from the finest grid instead of processing the DICOM again
+        if pyramid: # By slabs in out-of-core mode
+            save_pyramid(hdf, pyramid, mask_mode, None if scratchdir is None else slab)
+        if store is None and catalog is not None: # Store's writer does it otherwise
+            catalog.add(dname.stem, hdf, hname)
+    except BaseException:
+        close_hdf(hdf, remove) # Don't leave temporary files behind
+        raise
+    if store is None:
+        hdf.close()
+    else:
+        # Wait for the sequence to be committed, it holds its memory (counted in the budget) and
+        # is only done for the manifest once in the store. Store's writer closes (and removes) it
+        store.put(dname.stem, hdf, remove).result()
+
+def plan_seq(dname, pdir, voxres, pyramid=(), slab=None):
+    """
+    Estimate sequence's cost and memory from metadata, no frame is fetched but the DICOM is loaded
+    in full (see `--cached-sources`). `slab` is given in out-of-core mode.
+    """
+    nb_frames, shape = load_dcm_shape(load_dcm(dname), voxres)
+    seqdir = pdir.joinpath(dname.stem)
+    nb_meshes = len(list(seqdir.iterdir())) if seqdir.is_dir() else 0
+    nb_vox = int(np.prod(shape))
+    # Fetching frames and extruding meshes both scale with the grid size
+    cost = nb_vox * (nb_frames + nb_meshes)
+    # Every uint8 frame is kept until the end, each mesh gives a bool grid which is then
+    # copied in the HDF (chunk cache or memory), plus the one being extruded
+    memory = nb_vox * (nb_frames + 2 * nb_meshes + 1)
+    if slab is not None: # Only the fetched frame (and its contrast enhanced copy) stays in memory
+        memory = 2 * nb_vox
+    if pyramid:
+        # Grid (or slab and its halo) being downsampled, and its float copies
+        rows = shape[0] if slab is None else min(2 * slab, shape[0])
+        memory += 9 * nb_vox * rows // shape[0]
+        if slab is None: # Levels are kept as well
+            memory += sum(nb_vox / np.prod(res / voxres) for res in pyramid) * \
+                      (nb_frames + 2 * nb_meshes)
+        memory = int(memory)
+    info = f"{nb_frames} frames, shape {shape.tolist()}, {nb_meshes} meshes"
+    return Job(dname, cost, memory, info)
 
 
 @cli.command(context_settings={"help_option_names": ["--help", "-h"], "show_default": True})
@@ -51,30 +108,106 @@ def seq2vox(dname, pdir, opath, voxres, thickness, mode, contrast, postprocess):
             type=cli.Choice(["erosion", "dilation", "opening", "closing", "fill-holes"], case_sensitive=False),
             help=("If you want some binary post-processing on the annotation voxel grid. "
                   "This is useful for filter and region-growing extrusion."))
+@cli.option("--pyramid", "-P", type=cli.FloatRange(min=0), multiple=True,
+            help=("Coarser isotropic resolution in meter to derive from the voxel grids, can be "
+                  "repeated. Each level is saved in `Pyramid/levelXX` of the same HDF."))
+@cli.option("--mask-downsampling", "mask_mode", default="majority",
+            type=cli.Choice(["majority", "any"], case_sensitive=False),
+            help="How to downsample annotations for pyramid levels (block majority or any occupancy).")
+@cli.option("--store", "-s", "storepath", type=cli.Path(resolve_path=True, path_type=WindowsPath,
+            dir_okay=False),
+            help=("Append every sequence to this single HDF instead of one HDF per sequence. "
+                  "Sequences already in it are skipped, so an interrupted run can be resumed."))
 @cli.option("--ouput-directory", "-o", "opath", type=cli.Path(resolve_path=True,
             path_type=WindowsPath, file_okay=False), default="voxels",
             help="Where to store generated voxels.")
 @cli.option("--number-workers", "-n", "nb_workers", type=cli.IntRange(min=1), default=1,
             help="Number of workers used to accelerate file processing.")
-def all2vox(plydir, dcmdir, voxres, thickness, mode, contrast, postprocess, opath, nb_workers):
+@cli.option("--memory-budget", "-b", type=cli.FloatRange(min=0),
+            help=("Memory in GB that running sequences can use together, fewer workers run at "
+                  "once when sequences are big. No limit other than `number-workers` if not given."))
+@cli.option("--dry-run", is_flag=True, default=False,
+            help="Only print the planned order and memory estimate of each sequence.")
+@cli.option("--scratch-directory", "scratchdir",
+            type=cli.Path(resolve_path=True, path_type=WindowsPath, file_okay=False),
+            help=("Out-of-core mode: keep frames and annotations in memory-mapped files of this "
+                  "directory and process them by slabs, for grids that don't fit in memory."))
+@cli.option("--slab-size", "slab", type=cli.IntRange(min=1), default=32,
+            help="Number of voxels along first axis processed at once in out-of-core mode.")
+@cli.option("--catalog", "catalogpath", type=cli.Path(resolve_path=True, path_type=WindowsPath,
+            dir_okay=False),
+            help="SQLite catalog of written frames to update, see `convert.py query`.")
+@cli.option("--shard", metavar="INDEX/COUNT", callback=parse_shard,
+            help=("Only process sequences of shard INDEX (from 0) out of COUNT, and write a "
+                  "manifest of the processed ones. See `convert.py verify`."))
+@cli.option("--cached-sources", type=cli.IntRange(min=0), default=MAX_SOURCES,
+            help=("DICOMs each worker keeps open after planning them. Planning loads every DICOM "
+                  "in full (also with --dry-run) and, unless kept, it is loaded again when "
+                  "converted. Kept ones aren't if the same worker converts them, but cost memory, "
+                  "see `bench_pool.py`."))
+def all2vox(plydir, dcmdir, voxres, thickness, mode, contrast, postprocess, pyramid, mask_mode,
+            storepath, opath, nb_workers, memory_budget, dry_run, scratchdir, slab, catalogpath,
+            shard, cached_sources):
     """
     Convert given DICOMs and associated triangle meshes to voxel grids. Inputs are expected to
-    be grouped by sequence. Results will be stored in `output-directory/sequence-name.h5`.
+    be grouped by sequence. Results will be stored in `output-directory/sequence-name.h5`, or
+    appended to `store` if given.
     Meshes are extruded of `thickness` and voxelized in a grid of given resolution *and* shape.
     DICOMS are voxelized following the given resolution (shape will be arbitrary).
 
     \b
     PLYDIR    PATH    Directory of triangle meshes.
     DCMDIR    PATH    Directory of input dicoms (3D TEE).
+
+    Sequences are run largest first, their size is estimated from DICOMs' and meshes' metadata.
     """
-    opath.mkdir(exist_ok=True)
     voxres = np.array(voxres)
-    nb_sequences = len(list(dcmdir.glob("*.dcm")))
-    thread_map(lambda fname: seq2vox(fname, plydir, opath, voxres, thickness, mode,
-                                     contrast, postprocess),
-               dcmdir.iterdir(), max_workers=nb_workers,
-               # Pretty loading bar
-               desc="Processed", unit="sequence", total=nb_sequences, colour="green")
+    if any(np.any(res <= voxres) for res in pyramid):
+        raise cli.BadParameter("Pyramid levels must be coarser than voxel resolution.",
+                               param_hint="'--pyramid'")
+    dcms = sorted(dcmdir.glob("*.dcm"))
+    inputs = [ d.stem for d in dcms ]
+    dcms = [ d for d in dcms if in_shard(d.stem, shard) ]
+    done = set()
+    if storepath is not None and storepath.exists(): # Resume, don't plan what's already done
+        store = DatasetStore(storepath, 'r')
+        done = { d.stem for d in dcms } & set(store.names())
+        store.close()
+        dcms = [ d for d in dcms if d.stem not in done ]
+    POOL.max_sources = cached_sources
+    # Same workers plan and convert, so their DICOM loaders (and sources kept open) are reused
+    executor = ThreadPoolExecutor(nb_workers)
+    plan_job = lambda fname: plan_seq(fname, plydir, voxres, pyramid,
+                                      None if scratchdir is None else slab)
+    jobs = list(tqdm(executor.map(plan_job, dcms), total=len(dcms), desc="Planned",
+                     unit="sequence", colour="blue"))
+    memory_budget = memory_budget * GB if memory_budget else None
+    if dry_run:
+        executor.shutdown()
+        print_plan(jobs, memory_budget, nb_workers)
+        return
+    if storepath is None:
+        opath.mkdir(exist_ok=True)
+    else:
+        storepath.parent.mkdir(parents=True, exist_ok=True)
+    if scratchdir is not None:
+        scratchdir.mkdir(parents=True, exist_ok=True)
+    manifest = Manifest(opath if storepath is None else storepath.parent, "all2vox", shard,
+                        cli.get_current_context().params, inputs)
+    for name in done:
+        manifest.add(name)
+    catalog = None if catalogpath is None else Catalog(catalogpath)
+    writer = nullcontext() if storepath is None else StoreWriter(storepath, nb_workers, catalog)
+    # Manifest is saved and catalog closed after the store's writer is done, which is after
+    # running sequences are (executor is left first)
+    with manifest, catalog or nullcontext(), writer as store, executor:
+        budget_map(manifest.track(lambda fname: seq2vox(fname, plydir, opath, voxres, thickness,
+                                                        mode, contrast, postprocess, pyramid,
+                                                        mask_mode, store, scratchdir, slab,
+                                                        catalog)),
+                   jobs, max_workers=nb_workers, memory_budget=memory_budget, executor=executor,
+                   # Pretty loading bar
+                   desc="Processed", unit="sequence", colour="green")
 
 
 
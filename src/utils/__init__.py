@@ -1,3 +1,9 @@
+from utils.catalog import Catalog, read_frame
 from utils.lookup_table import LUT
-from utils.misc import get_affine, get_fname, to_labels, to_onehot
-from utils.voxels import resample_voxel_grid
+from utils.misc import frame_keys, get_affine, get_fname, to_labels, to_onehot
+from utils.pool import LoaderPool, StubLoader
+from utils.schedule import GB, Job, budget_map, print_plan
+from utils.shard import Manifest, in_shard, parse_shard, verify_manifests
+from utils.slabs import Scratch
+from utils.store import DatasetStore, StoreWriter, close_hdf, memory_hdf, scratch_hdf
+from utils.voxels import downsample_mask, downsample_voxel_grid, resample_voxel_grid, save_pyramid
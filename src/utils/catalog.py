@@ -0,0 +1,138 @@
+"""
+SQLite catalog of every frame written, to select frames without opening any HDF.
+"""
+
+import h5py
+import numpy as np
+import sqlite3
+
+from threading import Lock
+
+from utils.misc import frame_keys
+
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    sequence TEXT, level INTEGER, frame INTEGER, source TEXT, dataset TEXT, row INTEGER,
+    shape_x INTEGER, shape_y INTEGER, shape_z INTEGER, res_x REAL, res_y REAL, res_z REAL,
+    frame_time REAL, ecg_phase REAL, annotated INTEGER,
+    PRIMARY KEY (sequence, level, frame));
+CREATE TABLE IF NOT EXISTS masks (
+    sequence TEXT, level INTEGER, frame INTEGER, label TEXT, voxels INTEGER,
+    PRIMARY KEY (sequence, level, frame, label));
+CREATE INDEX IF NOT EXISTS frames_time ON frames (frame_time);
+CREATE INDEX IF NOT EXISTS frames_phase ON frames (ecg_phase);
+CREATE INDEX IF NOT EXISTS frames_res ON frames (res_x, res_y, res_z);
+CREATE INDEX IF NOT EXISTS masks_label ON masks (label, voxels);
+"""
+
+
+
+def _count(dset, slab=32):
+    # By slabs, masks may not fit in memory
+    return sum(int(np.count_nonzero(dset[i:i + slab])) for i in range(0, dset.shape[0], slab))
+
+def ecg_phase(ftime, ecg_times):
+    """ Fraction of the recorded R-R interval (between ECG trigger times) elapsed at `ftime` """
+    start, stop = ecg_times[0], ecg_times[-1]
+    if stop <= start:
+        return None
+    return float(np.clip((ftime - start) / (stop - start), 0, 1))
+
+
+class Catalog:
+    """
+    One row per (sequence, level, frame), shared by every worker of a run. Level 0 is the finest
+    grid, level `i` is `Pyramid/level<i>` (see `--pyramid`).
+    """
+    def __init__(self, fname):
+        self.db = sqlite3.connect(str(fname), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def add(self, name, hdf, source, locations=None):
+        """
+        Catalog frames of sequence `name`, at every level, from an open HDF with the per-sequence
+        layout. Frames are read from `source`, in `CartesianVolume/volXX` of each level unless
+        `locations` gives a `(dataset, row)` per frame and level (see `DatasetStore.append`).
+        Sequence's old rows are replaced.
+        """
+        ecg = hdf["ECG"]["times"][()] if "ECG" in hdf else None
+        levels = [ (0, '', hdf) ] + [ (int(k[len("level"):]), f"Pyramid/{k}/", lvl)
+                                      for k, lvl in hdf.get("Pyramid", {}).items() ]
+        frames, masks = [], []
+        for level, prefix, group in levels:
+            info, vols = group["VolumeGeometry"], group["CartesianVolume"]
+            keys = frame_keys(vols)
+            ftimes = info["frameTimes"][()] if "frameTimes" in info else [None] * len(keys)
+            res = info["resolution"][()]
+            gts = group.get("GroundTruth", {})
+            for i, k in enumerate(keys):
+                dataset, row = ((f"{prefix}CartesianVolume/{k}", None) if locations is None
+                                else locations[prefix][i])
+                ftime = None if ftimes[i] is None else float(ftimes[i])
+                phase = None if ftime is None or ecg is None else ecg_phase(ftime, ecg)
+                labels = [ l for l in gts.keys() if l.endswith(f"-{i + 1:02d}") ]
+                frames.append((name, level, i + 1, str(source), dataset, row,
+                               *map(int, vols[k].shape), *map(float, res), ftime, phase,
+                               bool(labels)))
+                for l in labels:
+                    masks.append((name, level, i + 1, l.rsplit('-', 1)[0], _count(gts[l])))
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM frames WHERE sequence = ?", (name,))
+            self.db.execute("DELETE FROM masks WHERE sequence = ?", (name,))
+            self.db.executemany(f"INSERT INTO frames VALUES ({', '.join('?' * 15)})", frames)
+            self.db.executemany("INSERT INTO masks VALUES (?, ?, ?, ?, ?)", masks)
+
+    def query(self, time=None, phase=None, resolution=None, shape=None, annotated=None,
+              label=None, min_voxels=1, where=None, level=None):
+        """
+        Frames matching every given criterion: `time` and `phase` are (min, max) ranges,
+        `resolution` and `shape` (x, y, z), `label` a mask with at least `min_voxels` voxels,
+        `where` any extra SQL condition on `frames` and `level` a pyramid level (0 the finest).
+        """
+        conds, args = [], []
+        if level is not None:
+            conds.append("level = ?")
+            args.append(level)
+        for col, bounds in (("frame_time", time), ("ecg_phase", phase)):
+            if bounds is not None:
+                conds.append(f"{col} BETWEEN ? AND ?")
+                args += list(bounds)
+        if resolution is not None: # Float comparison, to the micron
+            conds += [ f"ABS(res_{a} - ?) < 1e-6" for a in "xyz" ]
+            args += list(resolution)
+        if shape is not None:
+            conds += [ f"shape_{a} = ?" for a in "xyz" ]
+            args += list(shape)
+        if annotated is not None:
+            conds.append("annotated = ?")
+            args.append(annotated)
+        if label is not None:
+            conds.append("EXISTS (SELECT 1 FROM masks m WHERE m.sequence = frames.sequence "
+                         "AND m.level = frames.level AND m.frame = frames.frame "
+                         "AND m.label = ? AND m.voxels >= ?)")
+            args += [label, min_voxels]
+        if where is not None:
+            conds.append(f"({where})")
+        sql = "SELECT * FROM frames" + (" WHERE " + " AND ".join(conds) if conds else '')
+        with self.lock:
+            return self.db.execute(sql + " ORDER BY sequence, level, frame", args).fetchall()
+
+
+def read_frame(row):
+    """ Voxel grid of a row returned by `Catalog.query`, without walking the HDF """
+    with h5py.File(row["source"], 'r') as hdf:
+        dset = hdf[row["dataset"]]
+        return dset[()] if row["row"] is None else dset[row["row"]]
@@ -11,6 +11,10 @@ def get_affine(directions, spacing):
     return np.vstack([np.hstack([dirs, origin]), rotation])
 
 
+def frame_keys(vols):
+    """ `volXX` names of a CartesianVolume group in frame order, `vol100` comes after `vol99` """
+    return sorted(vols.keys(), key=lambda k: int(k[len("vol"):]))
+
 def get_fname(fname, dname, suffix, fidx=None):
     fidx = f"_{fidx}" if fidx is not None else ''
     return dname.joinpath(f"{fname.stem}{fidx}").with_suffix(suffix)
@@ -0,0 +1,69 @@
+"""
+Reuse file loaders across files instead of creating one per file. Nothing here depends on COM,
+any object with `LoadFile(str)` and `GetImageSource()` can be pooled.
+"""
+
+from collections import Counter, OrderedDict
+from threading import Lock, local
+from time import sleep
+
+
+
+class LoaderPool:
+    """
+    One loader per worker thread, created (and the thread initialized) on its first file, then
+    reused. Each worker also keeps its last `max_sources` image sources, so revisiting a file
+    doesn't load it again. Objects stay in the thread that created them, as COM requires.
+    """
+    def __init__(self, create_loader, init_worker=None, max_sources=0):
+        self.create_loader = create_loader
+        self.init_worker = init_worker
+        self.max_sources = max_sources
+        self.local = local()
+        self.lock = Lock()
+        self.stats = Counter() # Number of workers, loads and cache hits, to benchmark the pool
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def _worker(self):
+        if not hasattr(self.local, "loader"):
+            if self.init_worker is not None:
+                self.init_worker()
+            self.local.loader = self.create_loader()
+            self.local.sources = OrderedDict()
+            self._count("workers")
+        return self.local
+
+    def load(self, fname, keep=True):
+        """ Image source of `fname`, `keep=False` for its last read so it isn't kept cached """
+        worker, key = self._worker(), str(fname)
+        if key in worker.sources:
+            worker.sources.move_to_end(key)
+            self._count("hits")
+            return worker.sources[key] if keep else worker.sources.pop(key)
+        err_type, err_msg = worker.loader.LoadFile(key) #TODO? Print errors
+        src = worker.loader.GetImageSource()
+        self._count("loads")
+        if keep and self.max_sources > 0:
+            worker.sources[key] = src
+            while len(worker.sources) > self.max_sources:
+                worker.sources.popitem(last=False)
+        return src
+
+
+class StubLoader:
+    """ Stand-in for a file loader, to test and benchmark the pool without COM (e.g. on Linux) """
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.fname = None
+        sleep(delay) # Creating a loader isn't free either
+
+    def LoadFile(self, fname):
+        sleep(self.delay)
+        self.fname = fname
+        return 0, ''
+
+    def GetImageSource(self):
+        return self.fname
@@ -0,0 +1,58 @@
+"""
+Run jobs largest first, with as many workers as the memory budget allows.
+"""
+
+from collections import namedtuple
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from tqdm import tqdm
+
+
+
+# `cost` is only used to order jobs, `memory` is in bytes, `info` is printed in the plan
+Job = namedtuple("Job", ["fname", "cost", "memory", "info"])
+
+GB = 1e9
+
+
+
+def plan(jobs):
+    """ Longest jobs first, so a big one doesn't start last and dominate the tail """
+    return sorted(jobs, key=lambda j: j.cost, reverse=True)
+
+def print_plan(jobs, memory_budget=None, nb_workers=1):
+    total = sum(j.memory for j in jobs)
+    print(f"{len(jobs)} jobs, {nb_workers} workers, memory budget: "
+          + (f"{memory_budget / GB:.2f} GB" if memory_budget else "none"))
+    for i, job in enumerate(plan(jobs), start=1):
+        alone = " (runs alone)" if memory_budget and job.memory > memory_budget else ''
+        print(f"{i:>4}  {job.fname.name:<40} {job.memory / GB:>7.2f} GB  {job.info}{alone}")
+    print(f"Estimated memory of all jobs: {total / GB:.2f} GB")
+
+def budget_map(fn, jobs, max_workers=1, memory_budget=None, executor=None, **tqdm_kwargs):
+    """
+    Like `thread_map` over `job.fname`, but largest jobs first and without exceeding
+    `memory_budget` bytes. A job bigger than the budget runs alone. Jobs run in `executor` if
+    given (e.g. the one that planned them, so per-thread state is reused), it isn't shut down.
+    """
+    pending, running, used = plan(jobs), set(), 0
+    executor = nullcontext(executor) if executor else ThreadPoolExecutor(max_workers)
+    with executor as ex, tqdm(total=len(pending), **tqdm_kwargs) as pbar:
+        while pending or running:
+            # Fill free workers with the largest jobs. Once the largest one doesn't fit, smaller
+            # ones wait too, otherwise they would keep it (and a job bigger than the budget,
+            # which needs every other one done) from ever starting
+            while pending and len(running) < max_workers:
+                job = pending[0]
+                if memory_budget is not None and running and used + job.memory > memory_budget:
+                    break
+                pending.pop(0)
+                used += job.memory
+                future = ex.submit(fn, job.fname)
+                future.job = job
+                running.add(future)
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                used -= future.job.memory
+                pbar.update()
+                future.result() # Raise worker's error, if any
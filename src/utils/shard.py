@@ -0,0 +1,116 @@
+"""
+Deterministic split of inputs across nodes. Each node writes a manifest of what it produced, so
+shards can be checked against each other afterwards without any coordination.
+"""
+
+import click as cli
+import hashlib
+import json
+
+from collections import Counter
+from threading import Lock
+
+
+
+# Options that can differ between nodes without changing the results, paths are node specific
+RUNTIME = {"shard", "nb_workers", "memory_budget", "dry_run", "slab", "cached_sources",
+           "plydir", "dcmdir", "dicomdir", "idir", "gtdir", "hdfdir", "opath", "storepath",
+           "scratchdir", "catalogpath"}
+
+
+
+def parse_shard(ctx, param, value):
+    """ Click callback, `INDEX/COUNT` to `(index, count)` """
+    if value is None:
+        return None
+    try:
+        index, count = map(int, value.split('/'))
+    except ValueError:
+        raise cli.BadParameter("Expected INDEX/COUNT, e.g. 0/4.")
+    if count < 1:
+        raise cli.BadParameter("COUNT must be at least 1.")
+    if not 0 <= index < count:
+        raise cli.BadParameter(f"INDEX must be between 0 and {count - 1}.")
+    return index, count
+
+def in_shard(name, shard):
+    """ Whether input `name` belongs to `shard`, stable across runs and machines (unlike `hash`) """
+    if shard is None:
+        return True
+    index, count = shard
+    return int(hashlib.md5(name.encode()).hexdigest(), 16) % count == index
+
+
+class Manifest:
+    """
+    Completion manifest of one shard, saved in `odir` when leaving the context. Nothing is saved
+    when not sharding.
+    """
+    def __init__(self, odir, command, shard, params, inputs):
+        self.fname = None
+        if shard is not None:
+            self.fname = odir.joinpath(f"manifest-{shard[0]:03d}-of-{shard[1]:03d}.json")
+        params = { k: v for k, v in params.items() if k not in RUNTIME }
+        self.content = {"command": command, "shard": list(shard) if shard else None,
+                        # Through JSON so tuples and arrays compare equal once reloaded
+                        "parameters": json.loads(json.dumps(params, default=_tolist)),
+                        "inputs": sorted(inputs), "done": []}
+        self.todo = { n for n in inputs if in_shard(n, shard) }
+        self.lock = Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if self.fname is None:
+            return
+        # Saved even on error, so the shard can be resumed knowing what was done
+        self.content["complete"] = exc_type is None and self.todo.issubset(self.content["done"])
+        self.content["done"] = sorted(self.content["done"])
+        self.fname.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.fname, 'w') as fd:
+            json.dump(self.content, fd, indent=1)
+
+    def add(self, name):
+        with self.lock:
+            self.content["done"].append(name)
+
+    def track(self, fn):
+        """ Wrap `fn(fname)` to record `fname` as done once it returns """
+        def wrapper(fname):
+            out = fn(fname)
+            self.add(fname.stem)
+            return out
+        return wrapper
+
+def _tolist(obj):
+    return obj.tolist() if hasattr(obj, "tolist") else str(obj)
+
+
+def verify_manifests(manifests):
+    """ List of problems found across shards' manifests, empty if every input was done once """
+    errors = []
+    ref = manifests[0]
+    count = ref["shard"][1]
+    for m in manifests:
+        for k in ("command", "parameters", "inputs"):
+            if m[k] != ref[k]:
+                errors.append(f"Shard {m['shard'][0]}: different {k} from shard {ref['shard'][0]}.")
+        if m["shard"][1] != count:
+            errors.append(f"Shard {m['shard'][0]}: split in {m['shard'][1]} instead of {count}.")
+        if not m["complete"]:
+            errors.append(f"Shard {m['shard'][0]}: run did not complete.")
+        for n in m["done"]:
+            if not in_shard(n, m["shard"]):
+                errors.append(f"Shard {m['shard'][0]}: {n} belongs to another shard.")
+    indexes = Counter(m["shard"][0] for m in manifests)
+    for i in range(count):
+        if indexes[i] != 1:
+            errors.append(f"Shard {i}: found {indexes[i]} manifests instead of 1.")
+    done = Counter(n for m in manifests for n in m["done"])
+    for n in ref["inputs"]:
+        if done[n] != 1:
+            errors.append(f"{n}: produced {done[n]} times instead of once.")
+    for n in set(done) - set(ref["inputs"]):
+        errors.append(f"{n}: produced but not in inputs.")
+    return errors
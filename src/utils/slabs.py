@@ -0,0 +1,90 @@
+"""
+Out-of-core helpers: grids live in memory-mapped scratch files and are processed slab by slab
+along their first axis, each slab with enough overlap (halo) to be computed exactly.
+"""
+
+import numpy as np
+import scipy.ndimage as scn
+import shutil
+
+from itertools import count
+from pathlib import Path
+from tempfile import mkdtemp
+
+
+
+class Scratch:
+    """ Memory-mapped grids in a temporary directory, removed on `close` """
+    def __init__(self, directory, slab=32):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self.path = Path(mkdtemp(dir=directory))
+        self.slab = slab
+        self.counter = count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def zeros(self, shape, dtype):
+        fname = self.path.joinpath(f"{next(self.counter)}.dat")
+        return np.memmap(fname, dtype=dtype, mode="w+", shape=tuple(shape))
+
+    def close(self):
+        # On Windows, grids still referenced can't be removed, release them first
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def zeros(shape, dtype, scratch=None):
+    """ `np.zeros`, on disk if a `Scratch` is given """
+    return np.zeros(shape, dtype) if scratch is None else scratch.zeros(shape, dtype)
+
+def to_scratch(arr, scratch=None):
+    """ Move `arr` to disk if a `Scratch` is given """
+    if scratch is None:
+        return arr
+    out = scratch.zeros(arr.shape, arr.dtype)
+    out[:] = arr
+    return out
+
+
+def slabs(length, size, halo=0):
+    """ Bounds of each slab along first axis, and of the same slab with its halo """
+    for start in range(0, length, size):
+        stop = min(start + size, length)
+        yield start, stop, max(start - halo, 0), min(stop + halo, length)
+
+def slab_apply(fn, x, out, size, halo):
+    """ `out = fn(x)` slab by slab, `halo` must cover how far `fn` reaches along first axis """
+    for start, stop, lo, hi in slabs(x.shape[0], size, halo):
+        out[start:stop] = fn(np.asarray(x[lo:hi]))[start - lo:stop - lo]
+    return out
+
+def slab_zoom(x, out, size, order=1):
+    """
+    Same as `scn.zoom(x, ratio, mode="nearest", order=order)` with `ratio = out.shape / x.shape`,
+    reading `x` and writing `out` slab by slab. Identical for order 0, up to float rounding for
+    order 1.
+    """
+    # Zoom's mapping (grid_mode=False): output index `o` is input coordinate `o * scale`
+    scale = (np.array(x.shape) - 1) / np.maximum(np.array(out.shape) - 1, 1)
+    if order == 0:
+        # Nearest voxel rounded from global coordinates as zoom does, shifting coordinates to the
+        # slab first would flip some ties (.5)
+        idx = [ np.floor(np.arange(n) * s + 0.5).astype(int) for n, s in zip(out.shape, scale) ]
+        for start in range(0, out.shape[0], size):
+            rows = idx[0][start:start + size]
+            slab = np.asarray(x[rows[0]:rows[-1] + 1])
+            out[start:start + size] = slab[np.ix_(rows - rows[0], *idx[1:])]
+        return out
+    halo = order + 1
+    for start in range(0, out.shape[0], size):
+        stop = min(start + size, out.shape[0])
+        lo = max(int(np.floor(start * scale[0])) - halo, 0)
+        hi = min(int(np.ceil((stop - 1) * scale[0])) + halo + 1, x.shape[0])
+        slab = np.asarray(x[lo:hi]).astype(out.dtype)
+        out[start:stop] = scn.affine_transform(slab, scale, offset=(start * scale[0] - lo, 0, 0),
+                                               output_shape=(stop - start, *out.shape[1:]),
+                                               order=order, mode="nearest")
+    return out
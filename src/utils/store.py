@@ -0,0 +1,263 @@
+"""
+Consolidated store: every sequence is appended to a single HDF instead of one HDF per sequence.
+Frames are grouped by shape in resizable datasets, `index` tells where each sequence lives.
+"""
+
+import h5py
+import numpy as np
+import os
+
+from concurrent.futures import Future
+from io import BytesIO
+from queue import Queue
+from tempfile import mkstemp
+from threading import Thread
+
+from utils.misc import frame_keys
+
+
+
+INDEX_DTYPE = np.dtype([("name", "S128"), ("group", "S128"), ("start", np.int64),
+                        ("stop", np.int64), ("shape", np.int64, (3,)),
+                        ("origin", np.float64, (3,)), ("directions", np.float64, (3, 3)),
+                        ("resolution", np.float64, (3,)), ("annotated", bool),
+                        ("ecg_start", np.int64), ("ecg_stop", np.int64),
+                        ("cmap_start", np.int64), ("cmap_stop", np.int64)])
+# 1D data of arbitrary length stored back to back, with offsets saved in the index
+RAGGED = {"ECG/samples": "ecg", "ECG/times": "ecg", "colorMap": "cmap"}
+
+
+
+def memory_hdf():
+    """ HDF living in memory, with the same API as a file on disk """
+    return h5py.File(BytesIO(), 'w')
+
+def scratch_hdf(directory):
+    """ HDF in a temporary file of `directory`, for sequences that don't fit in memory """
+    fd, fname = mkstemp(suffix=".h5", dir=directory)
+    os.close(fd)
+    return h5py.File(fname, 'w')
+
+def close_hdf(hdf, remove=False):
+    """ Close `hdf`, and remove its file if `remove` (see `scratch_hdf`) """
+    fname = hdf.filename
+    hdf.close()
+    if remove:
+        os.remove(fname)
+
+def _require(hdf, path, shape, dtype, length=0, fillvalue=None):
+    if path not in hdf:
+        chunks = (1, *shape) if shape else (4096,)
+        hdf.create_dataset(path, shape=(length, *shape), maxshape=(None, *shape), dtype=dtype,
+                           chunks=chunks, fillvalue=fillvalue)
+    return hdf[path]
+
+def _append(dset, data):
+    start = dset.shape[0]
+    dset.resize(start + len(data), axis=0)
+    dset[start:] = data
+    return start, start + len(data)
+
+def _datasets(group):
+    out = []
+    group.visititems(lambda _, obj: out.append(obj) if isinstance(obj, h5py.Dataset) else None)
+    return out
+
+
+class DatasetStore:
+    """
+    Append-only HDF holding every sequence. A sequence is committed once its row is written in
+    `index`, anything written after the last committed row is dropped when reopening the store.
+    """
+    def __init__(self, fname, mode='a'):
+        self.hdf = h5py.File(fname, mode)
+        if mode != 'r':
+            self._rollback()
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    def close(self):
+        self.hdf.close()
+
+    def names(self):
+        if "index" not in self.hdf:
+            return []
+        return [ n.decode() for n in self.hdf["index"]["name"] ]
+
+    def _levels(self):
+        # Prefix of every resolution stored, finest first
+        return [''] + [ f"Pyramid/{k}/" for k in self.hdf.get("Pyramid", {}).keys() ]
+
+    def _rollback(self):
+        committed = set(self.names())
+        for prefix in self._levels():
+            if f"{prefix}index" not in self.hdf:
+                continue
+            index = self.hdf[f"{prefix}index"]
+            rows = index[()]
+            keep = len(rows)
+            # Uncommitted rows can only be at the end
+            while keep > 0 and rows["name"][keep - 1].decode() not in committed:
+                keep -= 1
+            index.resize(keep, axis=0)
+            for group in self.hdf.get(f"{prefix}frames", {}).values():
+                ingroup = rows[:keep][rows["group"][:keep] == group.name.encode()]
+                stop = ingroup["stop"].max() if ingroup.size else 0
+                for dset in _datasets(group):
+                    dset.resize(stop, axis=0)
+        rows = self.hdf["index"][()] if "index" in self.hdf else np.zeros(0, INDEX_DTYPE)
+        for path, field in RAGGED.items():
+            if path in self.hdf:
+                self.hdf[path].resize(rows[f"{field}_stop"].max() if rows.size else 0, axis=0)
+
+    def append(self, name, src):
+        """
+        Append sequence `name` from an open HDF following the per-sequence layout. Return where
+        its frames are, as `(dataset, row)` per frame, for each level (`''` for the finest one,
+        `Pyramid/levelXX/` otherwise).
+        """
+        row = np.zeros((), dtype=INDEX_DTYPE)
+        for path, field in RAGGED.items():
+            if path in src:
+                dset = _require(self.hdf, path, (), src[path].dtype)
+                row[f"{field}_start"], row[f"{field}_stop"] = _append(dset, src[path][()].ravel())
+        levels = [ (f"Pyramid/{k}/", lvl) for k, lvl in src.get("Pyramid", {}).items() ]
+        locations = {}
+        # Finest level is written last, its index row commits the whole sequence
+        for prefix, level in levels + [('', src)]:
+            gname, start, stop = self._append_level(name, prefix, level, row.copy())
+            locations[prefix] = [ (f"{gname}/CartesianVolume", i) for i in range(start, stop) ]
+        self.hdf.flush()
+        return locations
+
+    def _append_level(self, name, prefix, level, row):
+        info, vols = level["VolumeGeometry"], level.get("CartesianVolume", {})
+        keys = frame_keys(vols)
+        row["name"] = name
+        for k in ("origin", "directions", "resolution", "shape"):
+            if k in info:
+                row[k] = info[k][()]
+        if not keys: # E.g. no annotated frame, committed without frames like an empty HDF
+            _append(_require(self.hdf, f"{prefix}index", (), INDEX_DTYPE), row[None])
+            return '', 0, 0
+        shape = vols[keys[0]].shape
+        group = self.hdf.require_group(f"{prefix}frames/{'x'.join(map(str, shape))}")
+        vol = _require(group, "CartesianVolume", shape, vols[keys[0]].dtype)
+        start, stop = vol.shape[0], vol.shape[0] + len(keys)
+        for dset in _datasets(group):
+            dset.resize(stop, axis=0) # Missing masks and times are padded with fill value
+        for i, k in enumerate(keys):
+            vol[start + i] = vols[k][()]
+        ftimes = _require(group, "frameTimes", (), np.float64, stop, fillvalue=np.nan)
+        if "frameTimes" in info:
+            ftimes[start:stop] = info["frameTimes"][()][:len(keys)]
+        for k, dset in level.get("GroundTruth", {}).items():
+            label, fidx = k.rsplit('-', 1)
+            gt = _require(group, f"GroundTruth/{label}", shape, dset.dtype, stop)
+            gt[start + int(fidx) - 1] = dset[()]
+        row["group"] = group.name
+        row["start"], row["stop"], row["shape"] = start, stop, shape
+        row["annotated"] = len(level.get("GroundTruth", {})) > 0
+        _append(_require(self.hdf, f"{prefix}index", (), INDEX_DTYPE), row[None])
+        return group.name, start, stop
+
+    def _row(self, prefix, name):
+        rows = self.hdf[f"{prefix}index"][()]
+        match = rows[rows["name"] == name.encode()]
+        if match.size == 0:
+            raise KeyError(f"{name} not found in {self.hdf.filename}.")
+        return match[-1]
+
+    def export(self, name, fname):
+        """ Write sequence `name` to `fname` with the per-sequence layout """
+        hdf = h5py.File(fname, 'w')
+        row = self._row('', name)
+        for path, field in RAGGED.items():
+            start, stop = row[f"{field}_start"], row[f"{field}_stop"]
+            if path in self.hdf and stop > start:
+                hdf.create_dataset(path, data=self.hdf[path][start:stop])
+        self._export_level(row, hdf)
+        for prefix in self._levels()[1:]:
+            if name.encode() in self.hdf[f"{prefix}index"]["name"]: # Pyramid may be partial
+                self._export_level(self._row(prefix, name), hdf.create_group(prefix.rstrip('/')))
+        hdf.close()
+
+    def _export_level(self, row, dst):
+        start, stop = row["start"], row["stop"]
+        vol = dst.create_group("CartesianVolume")
+        info = dst.create_group("VolumeGeometry")
+        for k in ("origin", "directions", "resolution", "shape"):
+            info.create_dataset(k, data=row[k])
+        info.create_dataset("frameNumber", data=stop - start)
+        if stop == start: # Sequence without frames
+            return
+        group = self.hdf[row["group"].decode()]
+        for i in range(start, stop):
+            vol.create_dataset(f"vol{i - start + 1:02d}", data=group["CartesianVolume"][i])
+        if row["annotated"]:
+            gt = dst.create_group("GroundTruth")
+            for label, dset in group["GroundTruth"].items():
+                for i in range(start, stop):
+                    gt.create_dataset(f"{label}-{i - start + 1:02d}", data=dset[i])
+        ftimes = group["frameTimes"][start:stop]
+        if not np.all(np.isnan(ftimes)):
+            info.create_dataset("frameTimes", data=ftimes)
+
+
+class StoreWriter:
+    """
+    Single writer of a `DatasetStore`. Workers build their HDF in memory (see `memory_hdf`) or in a
+    temporary file (see `scratch_hdf`, then `remove=True`) and hand it over with `put`, the writer
+    thread appends it to the store, adds it to `catalog` if given, and closes it. Once an append
+    failed, `put` raises its error so the run stops instead of converting sequences for nothing.
+    `put` returns a future done once the sequence is committed (or failed), until then it still
+    holds its memory.
+    """
+    def __init__(self, fname, maxsize=1, catalog=None):
+        self.store = DatasetStore(fname, 'a')
+        self.catalog = catalog
+        self.done = set(self.store.names()) # Snapshot, used to resume
+        # Bounded so workers wait instead of piling up sequences in memory
+        self.queue = Queue(maxsize)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.error = None
+
+    def __contains__(self, name):
+        return name in self.done
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.queue.put(None)
+        self.thread.join()
+        self.store.close()
+        if self.error is not None:
+            raise self.error
+
+    def put(self, name, hdf, remove=False):
+        if self.error is not None: # Fail fast, later sequences would be dropped anyway
+            close_hdf(hdf, remove)
+            raise self.error
+        future = Future()
+        self.queue.put((name, hdf, remove, future))
+        return future
+
+    def _run(self):
+        while (item := self.queue.get()) is not None:
+            name, hdf, remove, future = item
+            try:
+                if self.error is None:
+                    locations = self.store.append(name, hdf)
+                    if self.catalog is not None:
+                        self.catalog.add(name, hdf, self.store.hdf.filename, locations)
+            except Exception as err: # Keep draining so workers don't block
+                self.error = err
+            finally:
+                close_hdf(hdf, remove)
+            if self.error is None:
+                future.set_result(name)
+            else:
+                future.set_exception(self.error)
@@ -3,20 +3,162 @@ import scipy.ndimage as scn
 
 from warnings import warn
 
+from utils.slabs import slab_zoom
+
 
 
 UNITS = {"meter": 1, "mm": 1e-3, "micron": 1e-6, "unknown": 1}
 
-def resample_voxel_grid(nimg, new_res=[0.0005, 0.0005, 0.0005], dtype=np.uint8, order=1):
+def resample_voxel_grid(nimg, new_res=[0.0005, 0.0005, 0.0005], dtype=np.uint8, order=1,
+                        scratch=None):
     # Expect `nib.Nift1Image
     old_res = np.array(nimg.header.get_zooms())[:3]
     conversion_rate = UNITS[nimg.header.get_xyzt_units()[0]]
     if conversion_rate == "unknown":
         warn("Unknown spatial unit, assume it's meter.", RuntimeWarning)
     old_res = conversion_rate * old_res
-    grid = np.array(nimg.dataobj, dtype=dtype)
     ratio = old_res / new_res
+    if scratch is not None: # Out-of-core, read and resample by slabs into a scratch file
+        shape = np.array(nimg.shape[-3:])
+        out = scratch.zeros((*nimg.shape[:-3], *np.round(shape * ratio).astype(int)), dtype)
+        if out.ndim == 4: # Stacked onehot encodings
+            for c in range(out.shape[0]):
+                slab_zoom(nimg.dataobj[c], out[c], scratch.slab, order)
+            return out
+        return slab_zoom(nimg.dataobj, out, scratch.slab, order)
+    grid = np.array(nimg.dataobj, dtype=dtype)
     if grid.ndim == 4: # We're dealing with stacked onehot encodings
         ratio = np.insert(ratio, 0, 1)
     # Order=0 => nearest interpolation, order=1 => linear interpolation
     return scn.zoom(grid, ratio, mode="nearest", order=order)
+
+
+def _block_view(grid, factor):
+    # Crop so every axis is a multiple of its factor, then expose blocks on odd axes
+    crop = tuple(slice(0, (s // f) * f) for s, f in zip(grid.shape, factor))
+    shape = [ d for s, f in zip(grid.shape, factor) for d in (s // f, f) ]
+    return grid[crop].reshape(shape)
+
+def _normalize(ratio):
+    # Integer ratios despite float errors (e.g. 0.0014 / 0.0007) use blocks
+    ratio = np.asarray(ratio, dtype=float)
+    return np.round(ratio) if np.allclose(ratio, np.round(ratio)) else ratio
+
+def coarse_shape(shape, ratio):
+    """ Shape of a grid downsampled by `ratio`, partial blocks at the end are dropped """
+    return tuple(np.floor(np.array(shape) / _normalize(ratio) + 1e-9).astype(int))
+
+def _coords(shape, ratio, start=0):
+    # Coarse voxel `i` covers fine voxels `[i * ratio, (i + 1) * ratio)`, so it's centred on fine
+    # coordinate `i * ratio + (ratio - 1) / 2`, whether blocks are used or not
+    starts = (start, *[0] * (len(shape) - 1))
+    return [ np.arange(s, s + n) * r + (r - 1) / 2 for s, n, r in zip(starts, shape, ratio) ]
+
+def _rows(grid, ratio, rows):
+    # Output shape, first coarse row and first fine row held by `grid`, see `downsample_voxel_grid`
+    shape = coarse_shape(grid.shape, ratio)
+    if rows is None:
+        return shape, 0, 0
+    start, stop, lo = rows
+    return (stop - start, *shape[1:]), start, lo
+
+def _window(length, ratio, start, stop):
+    # Fine rows needed to compute coarse rows `[start, stop)` exactly
+    r = ratio[0]
+    if np.all(ratio == np.round(ratio)): # Blocks, same test as `downsample_voxel_grid`
+        return int(start * r), int(stop * r)
+    halo = int(np.ceil(4 * r)) + 2 # Covers anti-aliasing filter (or footprint) and sampling
+    return max(int(start * r) - halo, 0), min(int(np.ceil(stop * r)) + halo, length)
+
+def downsample_voxel_grid(grid, ratio, order=1, rows=None):
+    """
+    Downsample intensities by `ratio` (>= 1) along each axis. Only coarse rows `(start, stop)`
+    along first axis are computed if `rows=(start, stop, lo)`, `grid` then holds fine rows from
+    `lo` (see `save_pyramid`).
+    """
+    ratio = _normalize(ratio)
+    shape, start, lo = _rows(grid, ratio, rows)
+    if np.all(ratio == np.round(ratio)): # Block-mean, exact and cheap
+        factor = ratio.astype(int)
+        grid = grid[start * factor[0] - lo:(start + shape[0]) * factor[0] - lo]
+        out = _block_view(grid, factor).mean(axis=(1, 3, 5))
+    else:
+        # Anti-aliasing before sampling, same sigma as skimage's `rescale`
+        sigma = np.maximum(0, (ratio - 1) / 2)
+        out = scn.gaussian_filter(grid.astype(np.float32), sigma, mode="nearest")
+        offset = (ratio - 1) / 2
+        offset[0] += start * ratio[0] - lo
+        out = scn.affine_transform(out, ratio, offset=offset, order=order, output_shape=shape,
+                                   mode="nearest")
+    if np.issubdtype(grid.dtype, np.integer):
+        out = np.round(out)
+    return out.astype(grid.dtype)
+
+def downsample_mask(mask, ratio, mode="majority", rows=None):
+    """ Downsample a binary mask by `ratio` (>= 1) along each axis, see `downsample_voxel_grid` """
+    ratio = _normalize(ratio)
+    shape, start, lo = _rows(mask, ratio, rows)
+    if np.all(ratio == np.round(ratio)):
+        factor = ratio.astype(int)
+        mask = mask[start * factor[0] - lo:(start + shape[0]) * factor[0] - lo]
+        blocks = _block_view(mask.astype(bool), factor)
+        if mode == "any":
+            return blocks.any(axis=(1, 3, 5))
+        return blocks.mean(axis=(1, 3, 5)) > 0.5 # Strict, ties would thicken thin leaflets
+    # Non integer ratio: aggregate over a footprint of the coarse voxel size, then sample it
+    size = np.ceil(ratio).astype(int)
+    if mode == "any":
+        occupancy = scn.maximum_filter(mask.astype(np.uint8), size, mode="nearest")
+    else:
+        occupancy = scn.uniform_filter(mask.astype(np.float32), size, mode="nearest")
+    # Nearest fine voxel of each coarse centre, rounded from global coordinates so slabs match
+    idx = [ np.floor(c + 0.5).astype(int) for c in _coords(shape, ratio, start) ]
+    idx[0] -= lo
+    occupancy = occupancy[np.ix_(*idx)]
+    return occupancy.astype(bool) if mode == "any" else occupancy > 0.5
+
+def _by_slabs(fn, src, dst, ratio, size):
+    # `dst = fn(src)` by `size` coarse rows, only reading the fine rows they need
+    for start in range(0, dst.shape[0], size):
+        stop = min(start + size, dst.shape[0])
+        lo, hi = _window(src.shape[0], ratio, start, stop)
+        dst[start:stop] = fn(src[lo:hi], ratio, rows=(start, stop, lo))
+
+def save_pyramid(hdf, resolutions, mask_mode="majority", slab=None):
+    """
+    Derive coarser levels from the finest grid already saved in `hdf`. Each level is stored in
+    `Pyramid/level<i>` with the same layout as the root (CartesianVolume, GroundTruth and
+    VolumeGeometry), geometry shared with the finest level is hard linked, not copied. Grids are
+    read and downsampled by `slab` fine voxels along first axis if given (out-of-core mode).
+    """
+    info = hdf["VolumeGeometry"]
+    voxres, shape = info["resolution"][()], info["shape"][()]
+    # Fine voxel steps along each axis, same mapping as `ply.voxelize.get_vox_idx`
+    steps = info["directions"][()] / shape[:, None]
+    pyramid = hdf.require_group("/Pyramid")
+    for i, res in enumerate(sorted(resolutions), start=1):
+        res = np.broadcast_to(np.asarray(res, dtype=float), voxres.shape)
+        ratio = _normalize(res / voxres)
+        cshape = coarse_shape(shape, ratio)
+        size = cshape[0] if slab is None else max(slab // int(np.ceil(ratio[0])), 1)
+        level = pyramid.create_group(f"level{i:02d}")
+        linfo = level.create_group("VolumeGeometry")
+        for k in info.keys():
+            if k not in ("resolution", "shape", "origin", "directions"):
+                linfo[k] = info[k] # Hard link
+        # Coarse voxel 0 is centred (ratio - 1) / 2 fine voxels from the origin, and the grid
+        # only spans whole coarse voxels
+        linfo.create_dataset("origin", data=info["origin"][()] + ((ratio - 1) / 2) @ steps)
+        linfo.create_dataset("directions", data=steps * (ratio * cshape)[:, None])
+        linfo.create_dataset("resolution", data=res)
+        linfo.create_dataset("shape", data=cshape)
+        vol = level.create_group("CartesianVolume")
+        for k, dset in hdf["CartesianVolume"].items():
+            out = vol.create_dataset(k, shape=coarse_shape(dset.shape, ratio), dtype=dset.dtype)
+            _by_slabs(downsample_voxel_grid, dset, out, ratio, size)
+        if "GroundTruth" in hdf:
+            gt = level.create_group("GroundTruth")
+            for k, dset in hdf["GroundTruth"].items():
+                out = gt.create_dataset(k, shape=coarse_shape(dset.shape, ratio), dtype=bool)
+                _by_slabs(lambda x, r, rows: downsample_mask(x, r, mask_mode, rows), dset, out,
+                          ratio, size)